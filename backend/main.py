@@ -2,19 +2,29 @@ import os
 import shutil
 import uuid
 import json
+import math
+import sqlite3
 import subprocess
 import uvicorn
-import re
+import aiofiles
+import av
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from pathlib import Path
 from typing import List, Optional
 from datetime import datetime
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
+from tasks import render_video
+
 # ============================================================================
 # CONFIGURATION & SETUP
 # ============================================================================
@@ -41,18 +51,53 @@ UPLOAD_DIR = BASE_DIR / "uploads" / "videos"
 OVERLAY_DIR = BASE_DIR / "uploads" / "overlays"
 OUTPUT_DIR = BASE_DIR / "outputs"
 JOBS_DIR = BASE_DIR / "jobs"
-
-# 🚀 BOSS MOVE: Clean up old jobs on server restart (Fixes 404/JSON errors)
-if JOBS_DIR.exists():
-    print("🧹 Cleaning up old job statuses...")
-    for file in JOBS_DIR.glob("*"):
-        try:
-            file.unlink()
-        except Exception:
-            pass
+JOBS_DB = JOBS_DIR / "jobs.db"
+SCRATCH_DIR = JOBS_DIR / "tmp" # Per-job temp files (filter scripts), wiped on restart
+UPLOAD_CHUNK_SIZE = 1 << 20 # 1 MiB per read, so big uploads yield to the event loop
+
+# Each ffmpeg already uses every core (-threads 0), so running many at once
+# just thrashes. Override with FFMPEG_MAX_JOBS.
+FFMPEG_MAX_JOBS = int(os.getenv("FFMPEG_MAX_JOBS", max(1, (os.cpu_count() or 1) // 4)))
+_ffmpeg_sem = threading.BoundedSemaphore(FFMPEG_MAX_JOBS)
+
+# Stream-copy overlay-free spans of at least MIN_COPY_SECONDS instead of
+# re-encoding them. Off by default (SEGMENT_COPY=1 enables): mid-track H.264
+# parameter changes at part boundaries are not yet verified on device
+# players (AVPlayer, MediaCodec). Up to SEGMENT_WORKERS copy
+# parts of one job run in parallel; re-encoded parts run one at a time, since
+# each already uses every core.
+SEGMENT_COPY = os.getenv("SEGMENT_COPY", "0") == "1"
+MIN_COPY_SECONDS = float(os.getenv("MIN_COPY_SECONDS", "5"))
+SEGMENT_WORKERS = min(os.cpu_count() or 1, 4)
+
+# Source H.264 profile -> libx264 -profile:v for re-encoded parts in copy mode
+X264_PROFILES = {
+    "Constrained Baseline": "baseline",
+    "Baseline": "baseline",
+    "Main": "main",
+    "High": "high",
+}
+
+# ffmpeg -progress line carrying the output timestamp in microseconds
+PROGRESS_TIME_KEY = b"out_time_us="
+
+# GPU encoders tried in order before falling back to libx264.
+# Set VIDEO_ENCODER to force one (e.g. VIDEO_ENCODER=libx264).
+# Each gets an explicit quality target near libx264's default CRF 23; left
+# alone they fall back to fixed low bitrates (videotoolbox: ~200 kb/s).
+HW_ENCODER_ARGS = {
+    "h264_nvenc": ['-preset', 'p1', '-tune', 'll', '-rc', 'vbr', '-cq', '23', '-b:v', '0'],
+    "h264_qsv": ['-preset', 'veryfast', '-global_quality', '23'],
+    "h264_videotoolbox": ['-realtime', '1', '-q:v', '65'],
+}
+X264_ARGS = [
+    '-preset', 'ultrafast',
+    '-tune', 'fastdecode',
+    '-x264-params', 'sliced-threads=1:sync-lookahead=0:rc-lookahead=10',
+]
 
 # Create directories
-for d in [UPLOAD_DIR, OVERLAY_DIR, OUTPUT_DIR, JOBS_DIR]:
+for d in [UPLOAD_DIR, OVERLAY_DIR, OUTPUT_DIR, SCRATCH_DIR]:
     d.mkdir(parents=True, exist_ok=True)
 
 # ============================================================================
@@ -80,6 +125,64 @@ class JobStatus(BaseModel):
 # UTILITY FUNCTIONS
 # ============================================================================
 
+class JobStore:
+    """Job statuses in one SQLite table (WAL mode) instead of a JSON file per job.
+    Rows come back as the same dicts the API has always returned."""
+
+    def __init__(self, db_path: Path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(db_path), timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY, status TEXT NOT NULL, progress INTEGER NOT NULL,"
+            " error TEXT, updated_at TEXT NOT NULL)"
+        )
+
+    def save(self, data: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, status, progress, error, updated_at)"
+                " VALUES (:job_id, :status, :progress, :error, :updated_at)"
+                " ON CONFLICT(job_id) DO UPDATE SET status=excluded.status,"
+                " progress=excluded.progress, error=excluded.error,"
+                " updated_at=excluded.updated_at",
+                data,
+            )
+
+    def load(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def all(self) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM jobs").fetchall()
+        return [dict(row) for row in rows]
+
+    def clear_finished(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE status != 'processing'")
+
+job_store = JobStore(JOBS_DB)
+
+# 🚀 BOSS MOVE: Clean up old jobs on restart (Fixes 404/JSON errors)
+# Called from the Celery worker's worker_ready hook, not API startup: the worker
+# owns the scratch files, and when it boots none of its renders are in flight.
+# Assumes one render worker per jobs/ directory. Rows still "processing" are
+# kept, since they're queued or will be redelivered (acks_late).
+def cleanup_old_jobs():
+    print("🧹 Cleaning up old job statuses...")
+    job_store.clear_finished()
+    shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+    SCRATCH_DIR.mkdir(parents=True, exist_ok=True)
+
 def save_job_status(job_id: str, status: str, progress: int = 0, error: str = None):
     data = {
         "job_id": job_id,
@@ -88,60 +191,306 @@ def save_job_status(job_id: str, status: str, progress: int = 0, error: str = No
         "error": error,
         "updated_at": datetime.now().isoformat()
     }
-    with open(JOBS_DIR / f"{job_id}.json", "w") as f:
-        json.dump(data, f)
+    job_store.save(data)
 
-# 🛠️ FIX: Crash-Proof Loader
 def load_job_status(job_id: str) -> dict:
-    job_file = JOBS_DIR / f"{job_id}.json"
-    if job_file.exists():
-        try:
-            with open(job_file, "r") as f:
-                content = f.read().strip()
-                if not content:
-                    return None # File is empty (race condition), return None to retry
-                return json.loads(content)
-        except json.JSONDecodeError:
-            return None # Corrupted file, retry next poll
-    return None
-
-def get_video_duration(input_path: Path) -> float:
-    cmd = [
-        'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-        '-of', 'default=noprint_wrappers=1:nokey=1', str(input_path)
-    ]
+    return job_store.load(job_id)
+
+@lru_cache(maxsize=1)
+def detect_video_encoder() -> str:
+    """Picks the first hardware H.264 encoder that ffmpeg lists *and* can open
+    with the flags real jobs use (being compiled in doesn't mean the GPU is
+    there, or that this build knows e.g. -preset p1). Probed once per process."""
+    forced = os.getenv("VIDEO_ENCODER")
+    if forced:
+        return forced
     try:
-        return float(subprocess.check_output(cmd).strip())
+        listing = subprocess.check_output(
+            ['ffmpeg', '-hide_banner', '-encoders'], stderr=subprocess.DEVNULL
+        ).decode(errors="ignore")
     except Exception as e:
-        print(f"⚠️ Error getting duration: {e}")
-        return 0.0
-
-def time_str_to_sec(time_str: str) -> float:
+        print(f"⚠️ Could not list ffmpeg encoders: {e}")
+        return "libx264"
+
+    for encoder in HW_ENCODER_ARGS:
+        if encoder not in listing:
+            continue
+        test_cmd = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', 'color=c=black:s=256x256:d=0.1',
+            '-c:v', encoder, *HW_ENCODER_ARGS[encoder], '-f', 'null', '-'
+        ]
+        if subprocess.run(test_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            print(f"⚡ Using hardware encoder: {encoder}")
+            return encoder
+    return "libx264"
+
+def video_encoder_args() -> List[str]:
+    encoder = detect_video_encoder()
+    if encoder == "libx264":
+        return ['-c:v', encoder, *X264_ARGS]
+    return ['-c:v', encoder, *HW_ENCODER_ARGS.get(encoder, [])]
+
+async def save_upload(upload: UploadFile, path: Path):
+    async with aiofiles.open(path, "wb") as f:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            await f.write(chunk)
+
+def probe_video(input_path: Path) -> tuple:
+    """Returns (width, height, duration), read in-process with PyAV (libavformat)
+    instead of forking ffprobe. Missing values come back as 0."""
+    try:
+        with av.open(str(input_path)) as container:
+            stream = container.streams.video[0]
+            width = stream.codec_context.width or 0
+            height = stream.codec_context.height or 0
+            if container.duration is not None:
+                duration = float(container.duration) / av.time_base
+            elif stream.duration is not None and stream.time_base:
+                duration = float(stream.duration * stream.time_base)
+            else:
+                duration = 0.0
+    except Exception as e:
+        print(f"⚠️ Error probing video: {e}")
+        return 0, 0, 0.0
+    return width, height, duration
+
+def filter_escape_path(path: Path) -> str:
+    """Path usable inside a quoted filter option (Windows drive colons escaped)."""
+    return path.as_posix().replace(":", "\\:")
+
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def stream_label(prefix: str, n: int) -> str:
+    """Short filtergraph label, e.g. stream_label('v', 40) -> '[v14]'.
+    The letter prefix keeps labels from being read as input indexes."""
+    digits = ""
+    while True:
+        n, r = divmod(n, 36)
+        digits = BASE36_DIGITS[r] + digits
+        if n == 0:
+            break
+    return f"[{prefix}{digits}]"
+
+def can_join_batch(batch: list, item: dict) -> bool:
+    """An overlay can share an xstack batch if it has the same time window
+    and does not overlap any rect already in it (xstack copies, never blends)."""
+    ov = item["ov"]
+    x, y, w, h = item["rect"]
+    if x < 0 or y < 0:
+        return False
+    for other in batch:
+        if (other["ov"].start_time, other["ov"].end_time) != (ov.start_time, ov.end_time):
+            return False
+        ox, oy, ow, oh = other["rect"]
+        if ox < 0 or oy < 0:
+            return False
+        if x < ox + ow and ox < x + w and y < oy + oh and oy < y + h:
+            return False
+    return True
+
+def is_opaque_video(input_path: Path) -> bool:
+    """True only if PyAV shows the first video stream has no alpha: a pixel
+    format without an alpha plane and no WebM alpha_mode side channel (VP9
+    decodes as yuv420p even when it carries alpha). Unknown counts as not opaque."""
+    try:
+        with av.open(str(input_path)) as container:
+            stream = container.streams.video[0]
+            fmt = stream.codec_context.format
+            if fmt is None or any(c.is_alpha for c in fmt.components):
+                return False
+            return stream.metadata.get("alpha_mode", stream.metadata.get("ALPHA_MODE")) != "1"
+    except Exception as e:
+        print(f"⚠️ Error checking overlay alpha: {e}")
+        return False
+
+def drop_occluded(items: list) -> list:
+    """Removes overlays fully covered, in space and time, by a later (higher)
+    overlay. Only opaque videos count as covers: images, and videos with alpha
+    (ProRes 4444, VP9 WebM), may have transparent areas."""
+    opaque = {}
+    kept = []
+    for i, item in enumerate(items):
+        ov = item["ov"]
+        x, y, w, h = item["rect"]
+        occluded = False
+        for cover in items[i + 1:]:
+            cov = cover["ov"]
+            cx, cy, cw, ch = cover["rect"]
+            if (cov.type == 'video'
+                    and cov.start_time <= ov.start_time and cov.end_time >= ov.end_time
+                    and cx <= x and cy <= y and cx + cw >= x + w and cy + ch >= y + h):
+                if cover["path"] not in opaque:
+                    opaque[cover["path"]] = is_opaque_video(cover["path"])
+                if opaque[cover["path"]]:
+                    occluded = True
+                    break
+        if occluded:
+            print(f"✂️ Skipping occluded overlay: {ov.content}")
+        else:
+            kept.append(item)
+    return kept
+
+def segment_source_info(input_path: Path) -> Optional[tuple]:
+    """(keyframe times in seconds from file start, libx264 args) for copy mode,
+    from demuxing only. The args make re-encoded parts match the source's
+    profile/level (and so its entropy coding) as closely as x264 can. None if
+    copied parts couldn't be concatenated with re-encoded ones: anything but
+    8-bit 4:2:0 Baseline/Main/High H.264 with AAC audio."""
     try:
-        h, m, s = time_str.split(':')
-        return int(h) * 3600 + int(m) * 60 + float(s)
-    except:
-        return 0.0
+        with av.open(str(input_path)) as container:
+            stream = container.streams.video[0]
+            ctx = stream.codec_context
+            if ctx.name != 'h264' or ctx.format is None or ctx.format.name != 'yuv420p':
+                return None
+            profile = X264_PROFILES.get(ctx.profile)
+            if profile is None:
+                return None
+            if any(a.codec_context.name != 'aac' for a in container.streams.audio):
+                return None
+            x264_args = [
+                '-c:v', 'libx264', '-preset', 'veryfast',
+                '-profile:v', profile, '-pix_fmt', 'yuv420p',
+            ]
+            level = getattr(ctx, "level", None)
+            if level and level > 0:
+                x264_args += ['-level', str(level)]
+            start = (container.start_time or 0) / av.time_base
+            keyframes = sorted(
+                float(packet.pts * stream.time_base) - start
+                for packet in container.demux(stream)
+                if packet.is_keyframe and packet.pts is not None
+            )
+            return keyframes, x264_args
+    except Exception as e:
+        print(f"⚠️ Error reading keyframes: {e}")
+        return None
+
+def timeline_gaps(windows: list, total_duration: float) -> list:
+    """Spans of [0, total_duration] not covered by any (start, end) window."""
+    gaps = []
+    cursor = 0.0
+    for start, end in sorted(windows):
+        start, end = max(0.0, start), min(total_duration, end)
+        if end <= start:
+            continue
+        if start > cursor:
+            gaps.append((cursor, start))
+        cursor = max(cursor, end)
+    if cursor < total_duration:
+        gaps.append((cursor, total_duration))
+    return gaps
+
+def plan_segments(gaps: list, keyframes: List[float], total_duration: float) -> list:
+    """Splits the timeline into (t0, t1, copy) parts. Copied parts start on a
+    keyframe and end on one (or at EOF) so `-c copy` cuts land exactly.
+    Returns [] when no gap is worth copying."""
+    segments = []
+    cursor = 0.0
+    for g0, g1 in gaps:
+        k0 = next((k for k in keyframes if k >= g0 - 0.001), None)
+        if g1 >= total_duration:
+            k1 = total_duration
+        else:
+            k1 = max((k for k in keyframes if k <= g1), default=None)
+        if k0 is None or k1 is None or k1 - k0 < MIN_COPY_SECONDS:
+            continue
+        if k0 > cursor:
+            segments.append((cursor, k0, False))
+        segments.append((k0, k1, True))
+        cursor = k1
+    if not segments:
+        return []
+    if cursor < total_duration:
+        segments.append((cursor, total_duration, False))
+    return segments
+
+def cut_args(t0: float, t1: float, copy: bool, total_duration: float) -> List[str]:
+    """-ss/-t for one part, in whole microseconds (ffmpeg truncates anything
+    finer). Copy parts round their start *up*: an input -ss with -c copy seeks
+    back to the keyframe at or before it, so rounding down would land a whole
+    GOP early and duplicate it. Re-encoded parts seek accurately and round
+    down so they keep the frame at t0. Ends round down, so the frame at t1
+    belongs to the next part only."""
+    start_us = math.ceil(t0 * 1_000_000) if copy else math.floor(t0 * 1_000_000)
+    cut = ['-ss', f"{start_us // 1_000_000}.{start_us % 1_000_000:06d}"]
+    if t1 < total_duration:
+        length_us = max(math.floor(t1 * 1_000_000) - start_us, 1)
+        cut += ['-t', f"{length_us // 1_000_000}.{length_us % 1_000_000:06d}"]
+    return cut
+
+def render_segments(job_id: str, video_path: Path, segments: list, thread_args: List[str],
+                    encode_args: List[str], total_duration: float, output_path: Path,
+                    scratch_files: list) -> int:
+    """Renders each part to MPEG-TS, then concatenates them into output_path.
+    Copy parts (I/O only) run in a pool while the re-encoded parts run one
+    after another here, so the job stays within its single _ffmpeg_sem slot.
+    Re-encoded parts keep source timestamps (-copyts) so overlay enable
+    windows stay absolute. Returns the first failing return code, or 0."""
+    parts = []
+    for n, (t0, t1, copy) in enumerate(segments):
+        part_path = SCRATCH_DIR / f"{job_id}_p{n}.ts"
+        scratch_files.append(part_path)
+        cut = cut_args(t0, t1, copy, total_duration)
+        if copy:
+            cmd = [
+                'ffmpeg', '-y', '-loglevel', 'error', '-nostats', *cut, '-i', str(video_path),
+                '-map', '0:v:0', '-map', '0:a?', '-c', 'copy',
+                '-f', 'mpegts', str(part_path)
+            ]
+        else:
+            cmd = [
+                'ffmpeg', '-y', '-loglevel', 'error', '-nostats', '-copyts', *thread_args,
+                *cut, *encode_args,
+                '-c:a', 'copy', '-f', 'mpegts', str(part_path)
+            ]
+        parts.append((part_path, t1 - t0, copy, cmd))
+
+    print(f"✂️ Job {job_id}: {len(parts)} parts, {sum(1 for seg in segments if seg[2])} stream-copied")
+
+    done = 0.0
+    with ThreadPoolExecutor(max_workers=SEGMENT_WORKERS) as pool:
+        copy_futures = {
+            pool.submit(subprocess.run, cmd): length
+            for _, length, copy, cmd in parts if copy
+        }
+        for _, length, copy, cmd in parts:
+            if copy:
+                continue
+            returncode = subprocess.run(cmd).returncode
+            if returncode != 0:
+                return returncode
+            done += length
+            save_job_status(job_id, "processing", min(int(done / total_duration * 95), 95))
+        for future in as_completed(copy_futures):
+            if future.result().returncode != 0:
+                return future.result().returncode
+            done += copy_futures[future]
+            save_job_status(job_id, "processing", min(int(done / total_duration * 95), 95))
+
+    list_path = SCRATCH_DIR / f"{job_id}_parts.txt"
+    scratch_files.append(list_path)
+    list_path.write_text("".join(f"file '{p.as_posix()}'\n" for p, _, _, _ in parts), encoding="utf-8")
+    concat_cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error', '-nostats', '-f', 'concat', '-safe', '0',
+        '-i', str(list_path), '-map', '0', '-c', 'copy',
+        # avc3: parameter sets stay in-band, so players don't rely on the
+        # first part's avcC for the parts that follow
+        '-tag:v', 'avc3', str(output_path)
+    ]
+    return subprocess.run(concat_cmd).returncode
 
 def process_video_task(job_id: str, video_path: Path, overlays: List[OverlayMetadata]):
+    scratch_files = [] # Filter script + drawtext files, removed when the job ends
     try:
         output_path = OUTPUT_DIR / f"{job_id}.mp4"
         
-        # 1. Probe Info
-        total_duration = get_video_duration(video_path)
+        # 1. Probe Info (dimensions + duration, read in-process by PyAV)
+        W, H, total_duration = probe_video(video_path)
         if total_duration == 0:
             raise Exception("Could not determine video duration. Is the file corrupted?")
-
-        # Get Dimensions
-        cmd_probe = [
-            'ffprobe', '-v', 'error', '-select_streams', 'v:0', 
-            '-show_entries', 'stream=width,height', '-of', 'csv=s=x:p=0', 
-            str(video_path)
-        ]
-        probe_out = subprocess.check_output(cmd_probe).decode().strip()
-        if not probe_out:
+        if not W or not H:
              raise Exception("Could not determine video dimensions.")
-        W, H = map(int, probe_out.split('x'))
 
         # 2. Build Filter
         input_args = ['-i', str(video_path)]
@@ -150,20 +499,15 @@ def process_video_task(job_id: str, video_path: Path, overlays: List[OverlayMeta
         
         save_job_status(job_id, "processing", 0)
 
-        for i, ov in enumerate(overlays):
+        media_items = []
+        text_overlays = []
+
+        for ov in overlays:
             x_px = int(ov.x * W)
             y_px = int(ov.y * H)
             
             if ov.type == 'text':
-                font_size = max(16, int((ov.height or 0.05) * H))
-                safe_text = ov.content.replace("'", "'\\''").replace(":", "\\:")
-                next_label = f"[v{i+1}]"
-                filter_complex += (
-                    f"{last_stream_label}drawtext=text='{safe_text}':"
-                    f"fontcolor=white:fontsize={font_size}:x={x_px}:y={y_px}:"
-                    f"enable='between(t,{ov.start_time},{ov.end_time})'{next_label};"
-                )
-                last_stream_label = next_label
+                text_overlays.append(ov)
 
             elif ov.type in ['image', 'video']:
                 ov_path = OVERLAY_DIR / ov.content
@@ -171,62 +515,196 @@ def process_video_task(job_id: str, video_path: Path, overlays: List[OverlayMeta
                     print(f"⚠️ Overlay file missing: {ov_path}")
                     continue
 
-                input_args.extend(['-i', str(ov_path)])
-                input_index = len(input_args) // 2 - 1 
-
                 target_w = int((ov.width or 0.2) * W)
                 target_h = int((ov.height or 0.2) * H)
                 if target_w % 2 != 0: target_w -= 1
                 if target_h % 2 != 0: target_h -= 1
 
-                scaled_label = f"[sc{i}]"
-                next_label = f"[v{i+1}]"
-
-                filter_complex += f"[{input_index}:v]scale={target_w}:{target_h}{scaled_label};"
-                filter_complex += (
+                media_items.append({
+                    "path": ov_path, "ov": ov,
+                    "rect": (x_px, y_px, target_w, target_h),
+                })
+
+        # Overlays hidden behind a later video for their whole window are never
+        # seen, so they get no input or filter nodes at all
+        media_items = drop_occluded(media_items)
+
+        # Image/video overlays are batched: consecutive ones sharing the same
+        # time window and not overlapping each other go through one xstack.
+        media_batches = []
+        for item in media_items:
+            input_args.extend(['-i', str(item["path"])])
+            item["input"] = len(input_args) // 2 - 1 
+
+            batch = media_batches[-1] if media_batches else None
+            if batch and can_join_batch(batch, item):
+                batch.append(item)
+            else:
+                media_batches.append([item])
+
+        # Scale/xstack branches are written before the overlay chain for
+        # readability only: ffmpeg links nodes by label, so the graph is the same
+        branches = ""
+        chain = ""
+        # Stacked inputs are numbered after the per-batch labels
+        scaled_count = 0
+        for b, batch in enumerate(media_batches):
+            ov = batch[0]["ov"]
+            enable = f"enable='between(t,{ov.start_time},{ov.end_time})'"
+            next_label = stream_label("v", b + 1)
+
+            if len(batch) == 1:
+                x_px, y_px, target_w, target_h = batch[0]["rect"]
+                scaled_label = stream_label("s", b)
+                branches += f"[{batch[0]['input']}:v]scale={target_w}:{target_h}{scaled_label};"
+                chain += (
                     f"{last_stream_label}{scaled_label}overlay={x_px}:{y_px}:"
-                    f"enable='between(t,{ov.start_time},{ov.end_time})'{next_label};"
+                    f"{enable}{next_label};"
                 )
-                last_stream_label = next_label
+            else:
+                stack_inputs = ""
+                for k, item in enumerate(batch):
+                    _, _, target_w, target_h = item["rect"]
+                    scaled_label = stream_label("s", len(media_batches) + scaled_count)
+                    scaled_count += 1
+                    branches += (
+                        f"[{item['input']}:v]scale={target_w}:{target_h},"
+                        f"setpts=PTS-STARTPTS,format=yuva420p{scaled_label};"
+                    )
+                    stack_inputs += scaled_label
+                # Canvas starts at the batch's top-left corner rather than the
+                # frame origin, so it only spans the overlays themselves
+                min_x = min(item["rect"][0] for item in batch)
+                min_y = min(item["rect"][1] for item in batch)
+                layout = "|".join(
+                    f"{item['rect'][0] - min_x}_{item['rect'][1] - min_y}" for item in batch
+                )
+                stacked_label = stream_label("x", b)
+                branches += (
+                    f"{stack_inputs}xstack=inputs={len(batch)}:layout={layout}:"
+                    f"fill=black@0{stacked_label};"
+                )
+                chain += (
+                    f"{last_stream_label}{stacked_label}overlay={min_x}:{min_y}:"
+                    f"{enable}{next_label};"
+                )
+            last_stream_label = next_label
+        filter_complex += branches + chain
+
+        # Text is drawn on top of the composited media, as one comma-joined
+        # drawtext chain: one graph segment, no intermediate labels between them
+        # Content is read from a file (textfile=, expansion=none), so quotes,
+        # colons, % and backslashes in user text never need escaping
+        text_filters = []
+        for i, ov in enumerate(text_overlays):
+            x_px = int(ov.x * W)
+            y_px = int(ov.y * H)
+            font_size = max(16, int((ov.height or 0.05) * H))
+            text_path = SCRATCH_DIR / f"{job_id}_t{i}.txt"
+            text_path.write_text(ov.content, encoding="utf-8")
+            scratch_files.append(text_path)
+            text_filters.append(
+                f"drawtext=textfile='{filter_escape_path(text_path)}':reload=0:expansion=none:"
+                f"fontcolor=white:fontsize={font_size}:x={x_px}:y={y_px}:"
+                f"enable='between(t,{ov.start_time},{ov.end_time})'"
+            )
+        if text_filters:
+            next_label = stream_label("t", 1)
+            filter_complex += f"{last_stream_label}{','.join(text_filters)}{next_label};"
+            last_stream_label = next_label
         
         filter_complex = filter_complex.rstrip(';')
         if not filter_complex:
             filter_complex = "null"
 
-        # 3. FFmpeg Command
-        cmd = [
-            'ffmpeg', '-y',
+        # Large graphs go through a script file to stay clear of ARG_MAX
+        filter_args = ['-filter_complex', filter_complex]
+        if len(filter_complex) > 4096 or len(overlays) > 8:
+            filter_path = SCRATCH_DIR / f"{job_id}.filter"
+            filter_path.write_text(filter_complex, encoding="utf-8")
+            scratch_files.append(filter_path)
+            filter_args = ['-filter_complex_script', str(filter_path)]
+
+        # 3. Timeline split: long spans without overlays are stream-copied
+        # instead of re-encoded, if the source can be concatenated as-is
+        windows = [(item["ov"].start_time, item["ov"].end_time) for item in media_items]
+        windows += [(ov.start_time, ov.end_time) for ov in text_overlays]
+        gaps = timeline_gaps(windows, total_duration)
+        segments = []
+        segment_encoder_args = []
+        if SEGMENT_COPY and any(g1 - g0 >= MIN_COPY_SECONDS for g0, g1 in gaps):
+            source_info = segment_source_info(video_path)
+            if source_info and source_info[0]:
+                keyframes, segment_encoder_args = source_info
+                segments = plan_segments(gaps, keyframes, total_duration)
+
+        # 4. FFmpeg Command
+        cpu_threads = str(os.cpu_count() or 1)
+        thread_args = [
+            '-filter_threads', cpu_threads,
+            '-filter_complex_threads', cpu_threads,
+        ]
+        graph_args = [
             *input_args,
-            '-filter_complex', filter_complex,
+            *filter_args,
             '-map', last_stream_label,
             '-map', '0:a?', 
-            '-c:v', 'libx264',
-            '-preset', 'ultrafast',
+        ]
+        cmd = [
+            'ffmpeg', '-y',
+            '-loglevel', 'error',
+            '-progress', 'pipe:1', '-nostats',
+            *thread_args,
+            *graph_args,
+            *video_encoder_args(),
+            '-threads', '0',
             '-c:a', 'aac',
             str(output_path)
         ]
 
         print(f"🎬 Processing Job {job_id}...")
         
-        process = subprocess.Popen(
-            cmd, 
-            stderr=subprocess.PIPE, 
-            universal_newlines=True
-        )
+        # Encoding is the CPU-bound stage: only FFMPEG_MAX_JOBS renders run at once.
+        # Probing and uploads above stay outside the semaphore.
+        with _ffmpeg_sem:
+            if segments:
+                # Re-encoded parts always use source-matched libx264, never a
+                # GPU encoder, so they can share one track with copied GOPs
+                returncode = render_segments(
+                    job_id, video_path, segments, thread_args,
+                    [*graph_args, *segment_encoder_args, '-threads', '0'],
+                    total_duration, output_path, scratch_files
+                )
+            else:
+                # Progress arrives as key=value lines on stdout; errors still go to stderr (server log).
+                # Lines are matched as raw bytes: no decode, no regex.
+                process = subprocess.Popen(
+                    cmd, 
+                    stdout=subprocess.PIPE
+                )
 
-        time_pattern = re.compile(r"time=(\d{2}:\d{2}:\d{2}\.\d{2})")
+                # Throttle status writes to at most one per second
+                last_write = 0.0
+                last_percent = 0
         
-        for line in process.stderr:
-            match = time_pattern.search(line)
-            if match:
-                current_sec = time_str_to_sec(match.group(1))
-                if total_duration > 0:
-                    percent = int((current_sec / total_duration) * 100)
-                    save_job_status(job_id, "processing", min(percent, 99))
-
-        process.wait()
-
-        if process.returncode == 0:
+                for line in process.stdout:
+                    if not line.startswith(PROGRESS_TIME_KEY):
+                        continue
+                    try:
+                        current_sec = int(line[len(PROGRESS_TIME_KEY):]) / 1_000_000
+                    except ValueError:
+                        continue # "N/A" before the first frame
+                    percent = min(int((current_sec / total_duration) * 100), 99)
+                    now = time.monotonic()
+                    if percent > last_percent and now - last_write >= 1.0:
+                        save_job_status(job_id, "processing", percent)
+                        last_write = now
+                        last_percent = percent
+
+                process.wait()
+                returncode = process.returncode
+
+        if returncode == 0:
             save_job_status(job_id, "completed", 100)
             print(f"✅ Job {job_id} Success!")
         else:
@@ -235,6 +713,9 @@ def process_video_task(job_id: str, video_path: Path, overlays: List[OverlayMeta
     except Exception as e:
         print(f"❌ Job {job_id} Failed: {e}")
         save_job_status(job_id, "failed", 0, str(e))
+    finally:
+        for path in scratch_files:
+            path.unlink(missing_ok=True)
 
 # ============================================================================
 # API
@@ -245,13 +726,12 @@ async def root():
     return {"status": "running"}
 
 @app.post("/upload")
-async def upload_video(background_tasks: BackgroundTasks, video: UploadFile = File(...), overlays: str = Form("[]")):
+async def upload_video(video: UploadFile = File(...), overlays: str = Form("[]")):
     try:
         job_id = str(uuid.uuid4())
         video_path = UPLOAD_DIR / f"{job_id}_{video.filename}"
         
-        with open(video_path, "wb") as f:
-            shutil.copyfileobj(video.file, f)
+        await save_upload(video, video_path)
         
         try:
             raw_overlays = json.loads(overlays)
@@ -259,8 +739,17 @@ async def upload_video(background_tasks: BackgroundTasks, video: UploadFile = Fi
         except json.JSONDecodeError:
             raise HTTPException(status_code=400, detail="Invalid JSON overlays")
         
-        save_job_status(job_id, "processing", 0)
-        background_tasks.add_task(process_video_task, job_id, video_path, overlay_data)
+        await run_in_threadpool(save_job_status, job_id, "processing", 0)
+        # Rendering runs in a Celery worker process, not in the API server.
+        # The enqueue is a blocking broker round-trip (with retries if Redis is
+        # down), so it goes through the threadpool too.
+        try:
+            await run_in_threadpool(
+                render_video.delay, job_id, str(video_path), [ov.dict() for ov in overlay_data]
+            )
+        except Exception as e:
+            await run_in_threadpool(save_job_status, job_id, "failed", 0, f"Could not queue job: {e}")
+            raise
         
         return {"job_id": job_id, "status": "processing"}
     except Exception as e:
@@ -273,21 +762,22 @@ async def upload_overlay(overlay: UploadFile = File(...), type: str = Form("imag
         filename = f"{uuid.uuid4()}{ext}"
         path = OVERLAY_DIR / filename
         
-        with open(path, "wb") as f:
-            shutil.copyfileobj(overlay.file, f)
+        await save_upload(overlay, path)
             
         return {"filename": filename, "type": type}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Job store reads block (SQLite + its lock), so these handlers are plain def:
+# FastAPI runs them in its threadpool instead of on the event loop
 @app.get("/status/{job_id}")
-async def get_status(job_id: str):
+def get_status(job_id: str):
     status = load_job_status(job_id)
     if not status: raise HTTPException(status_code=404, detail="Job not found")
     return status
 
 @app.get("/result/{job_id}")
-async def get_result(job_id: str):
+def get_result(job_id: str):
     status = load_job_status(job_id)
     if not status: raise HTTPException(status_code=404, detail="Job not found")
     if status["status"] != "completed": raise HTTPException(status_code=400, detail="Not ready")
@@ -298,12 +788,9 @@ async def get_result(job_id: str):
     return FileResponse(path=output_path, media_type="video/mp4", filename=f"render_{job_id}.mp4")
 
 @app.get("/jobs")
-async def list_jobs():
-    jobs_list = []
-    for job_file in JOBS_DIR.glob("*.json"):
-        with open(job_file, "r") as f:
-            jobs_list.append(json.load(f))
+def list_jobs():
+    jobs_list = job_store.all()
     return {"count": len(jobs_list), "jobs": jobs_list}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=int(os.getenv("API_WORKERS", "4")))
\ No newline at end of file
@@ -0,0 +1,41 @@
+import os
+from pathlib import Path
+from typing import List
+
+from celery import Celery
+from celery.signals import worker_ready
+
+# ============================================================================
+# CELERY WORKER
+# ============================================================================
+# Start from the backend folder:
+#   celery -A tasks worker --pool threads --concurrency=$(nproc)
+# The thread pool lets main.FFMPEG_MAX_JOBS cap concurrent encodes across
+# all tasks of a worker; with prefork each process would have its own cap.
+
+BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
+
+celery_app = Celery("video_editor", broker=BROKER_URL)
+celery_app.conf.update(
+    task_serializer="json",
+    accept_content=["json"],
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,  # Renders are long; don't hoard queued jobs
+)
+
+@worker_ready.connect
+def prepare_worker(**kwargs):
+    from main import cleanup_old_jobs, detect_video_encoder
+
+    # Nothing is rendering yet, so leftover scratch files are safe to drop
+    cleanup_old_jobs()
+    # Probe the GPU encoders once at boot rather than on the first job
+    detect_video_encoder()
+
+@celery_app.task(name="render_video")
+def render_video(job_id: str, video_path: str, overlays: List[dict]):
+    # Imported here: main imports this module to enqueue jobs
+    from main import OverlayMetadata, process_video_task
+
+    overlay_data = [OverlayMetadata(**item) for item in overlays]
+    process_video_task(job_id, Path(video_path), overlay_data)